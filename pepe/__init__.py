@@ -89,7 +89,6 @@ __version__ = '.'.join(map(str, __version_info__))
 
 import os
 import sys
-import types
 import re
 # We don't use cStringIO because it may have issues with writing UTF-8 encoded files.
 # http://mail.python.org/pipermail/python-list/2007-June/1097078.html
@@ -108,15 +107,29 @@ DEFAULT_CONTENT_TYPES_FILE = resource_filename(__name__, "content-types.yaml")
 
 logger = logging.getLogger("pepe")
 
-# TODO: Why is only one regexp prefixed with r''?
+# Notes on the pattern style, chosen to keep the regex engine from
+# backtracking on lines that are not (or are malformed) statements:
+# - [ \t] instead of \s between tokens: newline characters cannot
+#   appear there, so a larger class only costs rejection time. The one
+#   place a newline class does appear mid-line is the end of it: lines
+#   read in binary mode from CRLF input end "\r\n", which is why the
+#   comment-suffix tail built in get_statement_regexp() is [ \t\r]*,
+#   not [ \t]*.
+# - \S+ instead of the lazy [^\s]*? for names: a name is one greedy
+#   token bounded by whitespace, with no backtracking positions.
+# - [^"]* instead of the lazy .*? for the quoted #include form.
+# - expr/error/val keep their lazy tails: the trailing [ \t]* of the
+#   comment suffix is what trims trailing blanks off the captured text,
+#   and a greedy .* would capture them (breaking e.g. #ifdef, which
+#   quotes the raw capture into a defined() lookup).
 PREPROCESSOR_STATEMENT_REGEXP_PATTERNS = [
-    '#\s*(?P<op>if|elif|ifdef|ifndef)\s+(?P<expr>.*?)',
-    '#\s*(?P<op>else|endif)',
-    '#\s*(?P<op>error)\s+(?P<error>.*?)',
-    '#\s*(?P<op>define)\s+(?P<var>[^\s]*?)(\s+(?P<val>.+?))?',
-    '#\s*(?P<op>undef)\s+(?P<var>[^\s]*?)',
-    '#\s*(?P<op>include)\s+"(?P<fname>.*?)"',
-    r'#\s*(?P<op>include)\s+(?P<var>[^\s]+?)',
+    r'#[ \t]*(?P<op>if|elif|ifdef|ifndef)[ \t]+(?P<expr>.*?)',
+    r'#[ \t]*(?P<op>else|endif)',
+    r'#[ \t]*(?P<op>error)[ \t]+(?P<error>.*?)',
+    r'#[ \t]*(?P<op>define)[ \t]+(?P<var>\S+)([ \t]+(?P<val>.+?))?',
+    r'#[ \t]*(?P<op>undef)[ \t]+(?P<var>\S+)',
+    r'#[ \t]*(?P<op>include)[ \t]+"(?P<fname>[^"]*)"',
+    r'#[ \t]*(?P<op>include)[ \t]+(?P<var>\S+)',
 ]
 
 
@@ -145,6 +158,61 @@ class PreprocessorError(Exception):
         return s
 
 
+# Cache of absolute paths for the recursive-#include check. The same
+# files are absolutized over and over on deep include graphs, and
+# absolute_path() hits the filesystem/cwd each time.
+_absolute_path_cache = {}
+
+
+def _absolute_path(pathname):
+    try:
+        return _absolute_path_cache[pathname]
+    except KeyError:
+        result = _absolute_path_cache[pathname] = absolute_path(pathname)
+        return result
+
+
+# Cache of resolved #include targets, keyed by the include argument and
+# the directories searched, so a file included many times across a run
+# pays the normpath/exists probing of the include path only once.
+_include_resolution_cache = {}
+
+
+def _resolve_include(f, dirname, include_paths):
+    """
+    Resolves an #include argument against the including file's directory
+    followed by the include path. Returns the resolved path or ``None``
+    if the file was not found.
+    """
+    key = (f, dirname, tuple(include_paths))
+    try:
+        return _include_resolution_cache[key]
+    except KeyError:
+        pass
+    for d in [dirname] + include_paths:
+        fname = os.path.normpath(os.path.join(d, f))
+        if os.path.exists(fname):
+            _include_resolution_cache[key] = fname
+            return fname
+    return None
+
+
+# Cache of code objects for #if/#elif expression strings. The same
+# expression is often evaluated many times (e.g. the same #ifdef guard
+# across many files), and compile() dominates the cost of eval() on a
+# string.
+_expression_code_cache = {}
+
+
+def _compile_expression(expression):
+    try:
+        return _expression_code_cache[expression]
+    except KeyError:
+        code = compile(expression, "<preprocessor expression>", "eval")
+        _expression_code_cache[expression] = code
+        return code
+
+
 def _evaluate(expression, defines):
     """Evaluate the given expression string with the given context.
 
@@ -153,9 +221,11 @@ def _evaluate(expression, defines):
     """
     #interpolated = _interpolate(s, defines)
     try:
-        defined = {'defined': (lambda v: v in defines)}
-        return_value = eval(expression, defined, defines)
-    except Exception, ex:
+        # Bound __contains__ drops a Python-level lambda frame from
+        # every defined() call in user expressions.
+        defined = {'defined': defines.__contains__}
+        return_value = eval(_compile_expression(expression), defined, defines)
+    except Exception as ex:
         message = str(ex)
         if message.startswith("name '") and message.endswith("' is not defined"):
             # A common error (at least this is presumed:) is to have
@@ -175,7 +245,106 @@ def _evaluate(expression, defines):
     return return_value
 
 
-def get_statement_regexps(comment_groups):
+# Cache of compiled statement regexes keyed by comment groups so that
+# the patterns are compiled only once per process instead of on every
+# (possibly recursive) ``preprocess`` call.
+_statement_regexps_cache = {}
+
+_GROUP_NAME_REGEXP = re.compile(r"\(\?P<([A-Za-z_][A-Za-z0-9_]*)>")
+
+
+class StatementMatch(object):
+    """
+    Adapts a match against the combined statement regexp so that callers
+    can keep using the group names of the single-statement pattern that
+    matched (``op``, ``expr``, ``var``, ...).
+    """
+
+    def __init__(self, match, suffix, group_names):
+        self._match = match
+        self._suffix = suffix
+        self._group_names = group_names
+
+    def group(self, *names):
+        suffix = self._suffix
+        if len(names) == 1:
+            return self._match.group(names[0] + suffix)
+        return tuple(self._match.group(name + suffix) for name in names)
+
+    def groupdict(self):
+        match = self._match
+        suffix = self._suffix
+        return dict((name, match.group(name + suffix))
+                    for name in self._group_names)
+
+
+class StatementRegexp(object):
+    """
+    A single compiled regexp matching any preprocessor statement for a
+    set of comment groups.
+
+    All the per-statement patterns are fused into one alternation so
+    that the regex engine tries them in a single C-level call instead of
+    a Python-level loop over ~20 compiled patterns per input line. Group
+    names are made unique with a ``_<index>`` suffix per alternative;
+    ``match`` wraps a successful match in a ``StatementMatch`` that maps
+    the original names back.
+    """
+
+    def __init__(self, patterns, prefixes=None):
+        #: Tuple of literal comment prefixes a statement line must start
+        #: with (after leading whitespace), or ``None`` if any prefix is
+        #: a regex and no such fast rejection is possible.
+        self.prefixes = prefixes
+        alternatives = []
+        self._group_names_by_index = []
+        # Maps each capturing group number (1-based) of the combined
+        # regexp back to the alternative it belongs to.
+        self._index_by_group_number = []
+        for index, pattern in enumerate(patterns):
+            suffix = "_%d" % index
+            group_names = _GROUP_NAME_REGEXP.findall(pattern)
+            renamed = _GROUP_NAME_REGEXP.sub(r"(?P<\1%s>" % suffix, pattern)
+            alternatives.append("(?:%s)" % renamed)
+            self._group_names_by_index.append(group_names)
+            self._index_by_group_number.extend(
+                [index] * re.compile(renamed).groups)
+        self._regexp = re.compile("|".join(alternatives))
+
+    def possibly_matches(self, stripped_line):
+        """
+        Cheap tokenizer-style gate for the common case of a line that is
+        not a preprocessor statement. Every statement pattern is
+        <literal-prefix> [ \\t]* '#' ..., so a line whose leading
+        whitespace has been stripped can be rejected with string
+        operations alone: first a single startswith call against the
+        prefix tuple (throws out ordinary source lines), then a scan for
+        the '#' after the prefix (throws out ordinary comment lines).
+        Only returns False when the full regexp cannot possibly match;
+        callers must fall back to ``match`` when it returns True.
+        """
+        prefixes = self.prefixes
+        if not stripped_line.startswith(prefixes):
+            return False
+        for prefix in prefixes:
+            if stripped_line.startswith(prefix):
+                if stripped_line[len(prefix):].lstrip(" \t")[:1] == "#":
+                    return True
+        return False
+
+    def match(self, line):
+        match = self._regexp.match(line)
+        if match is None:
+            return None
+        # Only groups of the matched alternative participate in the
+        # match, so any participating group identifies it. (The ``op``
+        # group always participates; ``lastindex`` cannot be None.)
+        index = self._index_by_group_number[match.lastindex - 1]
+        return StatementMatch(match, "_%d" % index,
+                              self._group_names_by_index[index])
+
+
+def get_statement_regexp(comment_groups):
     # Generate statement parsing regexes. Basic format:
     #       <comment-prefix> <preprocessor-stmt> <comment-suffix>
     #  Examples:
@@ -188,23 +357,118 @@ def get_statement_regexps(comment_groups):
     #       # #else
     #       ...
     #       # #endif
+    # Comment groups are lists (unhashable), so key the cache on a tuple
+    # rendering of them. Several content types share the same comment
+    # groups, so this also shares compiled patterns between them.
+    cache_key = tuple(tuple(comment_group) for comment_group in comment_groups)
+    try:
+        return _statement_regexps_cache[cache_key]
+    except KeyError:
+        pass
+
+    # Collect the literal comment prefixes for fast rejection of
+    # non-statement lines. A compiled-regex prefix (e.g. Fortran's)
+    # cannot be checked with str.startswith, so it disables the fast
+    # path for the whole group set.
+    prefixes = []
+    for cprefix, _ in comment_groups:
+        if hasattr(cprefix, "pattern"):
+            prefixes = None
+            break
+        prefixes.append(cprefix)
+    if prefixes is not None:
+        prefixes = tuple(prefixes)
+
     patterns = []
     for preprocessor_statement_regexp in PREPROCESSOR_STATEMENT_REGEXP_PATTERNS:
         # The comment group prefix and suffix can either be just a
         # string or a compiled regex.
         for cprefix, csuffix in comment_groups:
+            # [ \t] instead of \s mid-line: \s drags in the newline
+            # classes and makes the engine test a larger character
+            # class before it can reject a non-statement line. The
+            # suffix tail additionally admits \r: files are read in
+            # binary mode, so lines from CRLF input end "\r\n" and $
+            # matches before the final \n only -- without \r in the
+            # class the statement would not match at all (or the \r
+            # would leak into the last capture group).
             if hasattr(cprefix, "pattern"):
                 pattern = cprefix.pattern
             else:
-                pattern = r"^\s*%s\s*" % re.escape(cprefix)
+                pattern = r"\A[ \t]*%s[ \t]*" % re.escape(cprefix)
             pattern += preprocessor_statement_regexp
             if hasattr(csuffix, "pattern"):
                 pattern += csuffix.pattern
             else:
-                pattern += r"\s*%s\s*$" % re.escape(csuffix)
+                pattern += r"[ \t]*%s[ \t\r]*$" % re.escape(csuffix)
             patterns.append(pattern)
-    statement_regexps = [re.compile(p) for p in patterns]
-    return statement_regexps
+    statement_regexp = StatementRegexp(patterns, prefixes)
+    _statement_regexps_cache[cache_key] = statement_regexp
+    return statement_regexp
+
+
+# Whether lines in the current #if-block section are skipped or emitted.
+SKIP, EMIT = range(2)
+
+# Statements that can change the set of defined names.
+_DEFINES_MUTATING_OPS = frozenset(['define', 'undef', 'include'])
+
+# Common literal #define values that need no eval().
+_DEFINE_VALUE_LITERALS = {'True': True, 'False': False, 'None': None}
+
+
+class IfBlockState(object):
+    """
+    State of one (possibly nested) #if block on the state stack.
+
+    Mutable attributes replace the (action, has_emitted, has_seen_else)
+    tuples previously stored on the stack: #elif/#else transitions now
+    update fields in place instead of allocating a replacement tuple.
+    """
+
+    __slots__ = ('action', 'has_emitted', 'has_seen_else')
+
+    def __init__(self, action, has_emitted=0, has_seen_else=0):
+        #: ``SKIP`` or ``EMIT`` lines in the current section.
+        self.action = action
+        #: Whether a section of this #if block has emitted lines.
+        self.has_emitted = has_emitted
+        #: Whether #else has been seen in this #if block.
+        self.has_seen_else = has_seen_else
+
+    def __repr__(self):
+        return "(%d, %d, %d)" % (self.action, self.has_emitted,
+                                 self.has_seen_else)
+
+
+# Compiled substitution regexps keyed by the set of defined names.
+# #define/#undef pairs and recursive includes keep toggling between the
+# same few name sets, so the sort and compile below are worth memoizing
+# across preprocess() calls, not just within one.
+_substitution_regexp_cache = {}
+
+
+def get_substitution_regexp(defines):
+    """
+    Returns a compiled regexp matching any variable name defined in the
+    given mapping.
+
+    :param defines:
+        The dictionary of defined variables.
+    :return:
+        A compiled regexp whose alternatives are the defined names,
+        longest first, so that a name that is a prefix of another cannot
+        shadow the longer match. This mirrors the longest-first ordering
+        of the ``str.replace`` loop it replaces.
+    """
+    cache_key = frozenset(defines)
+    try:
+        return _substitution_regexp_cache[cache_key]
+    except KeyError:
+        names = sorted(defines, key=len, reverse=True)
+        regexp = re.compile("|".join([re.escape(name) for name in names]))
+        _substitution_regexp_cache[cache_key] = regexp
+        return regexp
 
 
 def preprocess(input_file,
@@ -250,21 +514,22 @@ def preprocess(input_file,
     defines = defines or {}
 
     # Ensure preprocessing isn't cyclic(?).
-    _preprocessed_files = _preprocessed_files or []
-    input_file_absolute_path = absolute_path(input_filename)
+    if _preprocessed_files is None:
+        _preprocessed_files = set()
+    input_file_absolute_path = _absolute_path(input_filename)
     if input_file_absolute_path in _preprocessed_files:
         raise PreprocessorError("detected recursive #include of '%s'"\
                                 % input_filename)
-    _preprocessed_files.append(input_file_absolute_path)
+    _preprocessed_files.add(input_file_absolute_path)
 
     # Determine the content type and comment info for the input file.
     comment_groups = content_types_db.get_comment_group_for_path(input_filename, default_content_type)
-    statement_regexps = get_statement_regexps(comment_groups)
+    statement_regexp = get_statement_regexp(comment_groups)
+    statement_prefixes = statement_regexp.prefixes
 
     # Process the input file.
     # (Would be helpful if I knew anything about lexing and parsing
     # simple grammars.)
-    input_lines = input_file.readlines()
     if _depth == 0:
         # Only at recursion depth 0 is the temporary buffer created.
         temp_output_buffer = StringIO()
@@ -272,178 +537,243 @@ def preprocess(input_file,
         # At deeper levels, the temporary buffer is the output file.
         temp_output_buffer = output_file
 
+    # Emitted lines are batched here and written to the buffer in one
+    # join/write instead of a write call per line. The batch must be
+    # flushed before an #include recursion writes its own output.
+    output_lines = []
+
+    def _flush_output_lines():
+        if output_lines:
+            temp_output_buffer.write("".join(output_lines))
+            del output_lines[:]
+
     defines['__FILE__'] = input_filename
-    SKIP, EMIT = range(2) # states
-    states = [(EMIT, # a state is (<emit-or-skip-lines-in-this-section>,
-               0, #             <have-emitted-in-this-if-block>,
-               0)]     #             <have-seen-'else'-in-this-if-block>)
-    line_number = 0
-    for line in input_lines:
-        line_number += 1
+    states = [IfBlockState(EMIT)]
+
+    # Statement handlers, dispatched on the matched op through a dict
+    # lookup instead of a long elif chain. They close over the local
+    # processing state above.
+    def _do_define(op, match, line):
+        if not (states and states[-1].action == SKIP):
+            var, val = match.group("var", "val")
+            if val is not None:
+                # Most values are plain literals; recognize those
+                # directly instead of spinning up eval() (a full
+                # parse/compile/frame setup) per #define.
+                if val in _DEFINE_VALUE_LITERALS:
+                    val = _DEFINE_VALUE_LITERALS[val]
+                elif val.isdigit() and (val == "0" or val[0] != "0"):
+                    # Plain decimal integer. Leading-zero forms fall
+                    # through to eval() to keep their octal semantics.
+                    val = int(val)
+                else:
+                    try:
+                        val = eval(val, {}, {})
+                    except:
+                        pass
+            defines[var] = val
+
+    def _do_undef(op, match, line):
+        if not (states and states[-1].action == SKIP):
+            var = match.group("var")
+            try:
+                del defines[var]
+            except KeyError:
+                pass
+
+    def _do_include(op, match, line):
+        if not (states and states[-1].action == SKIP):
+            if "var" in match.groupdict():
+                # This is the second include form: #include VAR
+                var = match.group("var")
+                f = defines[var]
+            else:
+                # This is the first include form: #include "path"
+                f = match.group("fname")
+
+            fname = _resolve_include(f, os.path.dirname(input_filename),
+                                     include_paths)
+            if fname is None:
+                raise PreprocessorError(
+                    "could not find #include'd file "\
+                    "\"%s\" on include path: %r"\
+                    % (f, include_paths))
+            _flush_output_lines()
+            with open(fname, 'rb') as f:
+                # ``defines`` is modified in place; the recursive call
+                # returns the same dictionary object.
+                preprocess(f,
+                           temp_output_buffer,
+                           defines=defines,
+                           options=options,
+                           content_types_db=content_types_db,
+                           _preprocessed_files=_preprocessed_files,
+                           _depth=1)
+
+    def _do_if(op, match, line):
+        if op == "if":
+            expr = match.group("expr")
+        elif op == "ifdef":
+            expr = "defined('%s')" % match.group("expr")
+        elif op == "ifndef":
+            expr = "not defined('%s')" % match.group("expr")
+        try:
+            if states and states[-1].action == SKIP:
+                # Were are nested in a SKIP-portion of an if-block.
+                states.append(IfBlockState(SKIP))
+            elif _evaluate(expr, defines):
+                states.append(IfBlockState(EMIT, has_emitted=1))
+            else:
+                states.append(IfBlockState(SKIP))
+        except KeyError:
+            raise PreprocessorError("use of undefined variable in "\
+                                    "#%s stmt" % op, defines['__FILE__']
+                                    ,
+                                    defines['__LINE__'], line)
+
+    def _do_elif(op, match, line):
+        expr = match.group("expr")
+        try:
+            if states[-1].has_seen_else: # already had #else in this if-block
+                raise PreprocessorError("illegal #elif after #else in "\
+                                        "same #if block",
+                                        defines['__FILE__'],
+                                        defines['__LINE__'], line)
+            elif states[-1].has_emitted: # if have emitted in this if-block
+                states[-1].action = SKIP
+            elif states[:-1] and states[-2].action == SKIP:
+                # Were are nested in a SKIP-portion of an if-block.
+                states[-1].action = SKIP
+            elif _evaluate(expr, defines):
+                states[-1].action = EMIT
+                states[-1].has_emitted = 1
+            else:
+                states[-1].action = SKIP
+        except IndexError:
+            raise PreprocessorError("#elif stmt without leading #if "\
+                                    "stmt", defines['__FILE__'],
+                                    defines['__LINE__'], line)
+
+    def _do_else(op, match, line):
+        try:
+            if states[-1].has_seen_else: # already had #else in this if-block
+                raise PreprocessorError("illegal #else after #else in "\
+                                        "same #if block",
+                                        defines['__FILE__'],
+                                        defines['__LINE__'], line)
+            elif states[-1].has_emitted: # if have emitted in this if-block
+                states[-1].action = SKIP
+                states[-1].has_seen_else = 1
+            elif states[:-1] and states[-2].action == SKIP:
+                # Were are nested in a SKIP-portion of an if-block.
+                states[-1].action = SKIP
+                states[-1].has_seen_else = 1
+            else:
+                states[-1].action = EMIT
+                states[-1].has_emitted = 1
+                states[-1].has_seen_else = 1
+        except IndexError:
+            raise PreprocessorError("#else stmt without leading #if "\
+                                    "stmt", defines['__FILE__'],
+                                    defines['__LINE__'], line)
+
+    def _do_endif(op, match, line):
+        try:
+            states.pop()
+        except IndexError:
+            raise PreprocessorError("#endif stmt without leading #if"\
+                                    "stmt", defines['__FILE__'],
+                                    defines['__LINE__'], line)
+
+    def _do_error(op, match, line):
+        if not (states and states[-1].action == SKIP):
+            error = match.group("error")
+            raise PreprocessorError("#error: " + error,
+                                    defines['__FILE__'],
+                                    defines['__LINE__'], line)
+
+    op_handlers = {
+        'define': _do_define,
+        'undef': _do_undef,
+        'include': _do_include,
+        'if': _do_if,
+        'ifdef': _do_if,
+        'ifndef': _do_if,
+        'elif': _do_elif,
+        'else': _do_else,
+        'endif': _do_endif,
+        'error': _do_error,
+    }
+
+    substitution_regexp = None # rebuilt lazily when defined names change
+    # Iterate the file object directly rather than materializing the
+    # whole file with readlines(): peak memory stays at one line and the
+    # buffered C-level iterator is faster than list traversal.
+    # __LINE__ is published into defines lazily, only where something
+    # can observe it (statement evaluation and -s substitution), rather
+    # than with a dict store on every line of input.
+    for line_number, line in enumerate(input_file, 1):
         logger.debug("line %d: %r", line_number, line)
-        defines['__LINE__'] = line_number
 
-        # Is this line a preprocessor stmt line?
-        #XXX Could probably speed this up by optimizing common case of
-        #    line NOT being a preprocessor stmt line.
-        for statement_regexp in statement_regexps:
-            match = statement_regexp.match(line)
-            if match:
-                break
-        else:
+        # Is this line a preprocessor stmt line? The common case is that
+        # it is not, and for literal comment prefixes possibly_matches
+        # rejects both ordinary source lines and ordinary comment lines
+        # with a few string operations before any regex work.
+        if statement_prefixes is not None and \
+                not statement_regexp.possibly_matches(line.lstrip()):
             match = None
+        else:
+            match = statement_regexp.match(line)
 
         if match:
             op = match.group("op")
             logger.debug("%r stmt (states: %r)", op, states)
-            if op == "define":
-                if not (states and states[-1][0] == SKIP):
-                    var, val = match.group("var", "val")
-                    if val is None:
-                        val = None
-                    else:
-                        try:
-                            val = eval(val, {}, {})
-                        except:
-                            pass
-                    defines[var] = val
-            elif op == "undef":
-                if not (states and states[-1][0] == SKIP):
-                    var = match.group("var")
-                    try:
-                        del defines[var]
-                    except KeyError:
-                        pass
-            elif op == "include":
-                if not (states and states[-1][0] == SKIP):
-                    if "var" in match.groupdict():
-                        # This is the second include form: #include VAR
-                        var = match.group("var")
-                        f = defines[var]
-                    else:
-                        # This is the first include form: #include "path"
-                        f = match.group("fname")
-
-                    for d in [os.path.dirname(input_filename)] + include_paths:
-                        fname = os.path.normpath(os.path.join(d, f))
-                        if os.path.exists(fname):
-                            break
-                    else:
-                        raise PreprocessorError(
-                            "could not find #include'd file "\
-                            "\"%s\" on include path: %r"\
-                            % (f, include_paths))
-                    with open(fname, 'rb') as f:
-                        defines = preprocess(f,
-                                             temp_output_buffer,
-                                             defines=defines,
-                                             options=options,
-                                             content_types_db=content_types_db,
-                                             _preprocessed_files=_preprocessed_files,
-                                             _depth=1)
-            elif op in ("if", "ifdef", "ifndef"):
-                if op == "if":
-                    expr = match.group("expr")
-                elif op == "ifdef":
-                    expr = "defined('%s')" % match.group("expr")
-                elif op == "ifndef":
-                    expr = "not defined('%s')" % match.group("expr")
-                try:
-                    if states and states[-1][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states.append((SKIP, 0, 0))
-                    elif _evaluate(expr, defines):
-                        states.append((EMIT, 1, 0))
-                    else:
-                        states.append((SKIP, 0, 0))
-                except KeyError:
-                    raise PreprocessorError("use of undefined variable in "\
-                                            "#%s stmt" % op, defines['__FILE__']
-                                            ,
-                                            defines['__LINE__'], line)
-            elif op == "elif":
-                expr = match.group("expr")
-                try:
-                    if states[-1][2]: # already had #else in this if-block
-                        raise PreprocessorError("illegal #elif after #else in "\
-                                                "same #if block",
-                                                defines['__FILE__'],
-                                                defines['__LINE__'], line)
-                    elif states[-1][1]: # if have emitted in this if-block
-                        states[-1] = (SKIP, 1, 0)
-                    elif states[:-1] and states[-2][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states[-1] = (SKIP, 0, 0)
-                    elif _evaluate(expr, defines):
-                        states[-1] = (EMIT, 1, 0)
-                    else:
-                        states[-1] = (SKIP, 0, 0)
-                except IndexError:
-                    raise PreprocessorError("#elif stmt without leading #if "\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "else":
-                try:
-                    if states[-1][2]: # already had #else in this if-block
-                        raise PreprocessorError("illegal #else after #else in "\
-                                                "same #if block",
-                                                defines['__FILE__'],
-                                                defines['__LINE__'], line)
-                    elif states[-1][1]: # if have emitted in this if-block
-                        states[-1] = (SKIP, 1, 1)
-                    elif states[:-1] and states[-2][0] == SKIP:
-                        # Were are nested in a SKIP-portion of an if-block.
-                        states[-1] = (SKIP, 0, 1)
-                    else:
-                        states[-1] = (EMIT, 1, 1)
-                except IndexError:
-                    raise PreprocessorError("#else stmt without leading #if "\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "endif":
-                try:
-                    states.pop()
-                except IndexError:
-                    raise PreprocessorError("#endif stmt without leading #if"\
-                                            "stmt", defines['__FILE__'],
-                                            defines['__LINE__'], line)
-            elif op == "error":
-                if not (states and states[-1][0] == SKIP):
-                    error = match.group("error")
-                    raise PreprocessorError("#error: " + error,
-                                            defines['__FILE__'],
-                                            defines['__LINE__'], line)
+            defines['__LINE__'] = line_number
+            op_handlers[op](op, match, line)
+            if op in _DEFINES_MUTATING_OPS:
+                # The statement (or an included file) may have changed
+                # the set of defined names.
+                substitution_regexp = None
             logger.debug("states: %r", states)
             if should_keep_lines:
-                temp_output_buffer.write("\n")
+                output_lines.append("\n")
         else:
             try:
-                if states[-1][0] == EMIT:
-                    logger.debug("emit line (%s)" % states[-1][1])
-                    # Substitute all defines into line.
-                    # XXX Should avoid recursive substitutions. But that
-                    #     would be a pain right now.
+                if states[-1].action == EMIT:
+                    logger.debug("emit line (%s)" % states[-1].has_emitted)
+                    # Substitute all defines into line in a single regex
+                    # pass. Values are looked up in the callback, so the
+                    # regexp only needs rebuilding when the set of
+                    # defined names changes. Unlike the sequential
+                    # str.replace loop this replaces, one pass cannot
+                    # recursively substitute names introduced by an
+                    # earlier replacement value.
                     sline = line
                     if should_substitute:
-                        for name in reversed(sorted(defines, key=len)):
-                            value = defines[name]
-                            sline = sline.replace(name, str(value))
-                    temp_output_buffer.write(sline)
+                        defines['__LINE__'] = line_number
+                        if substitution_regexp is None:
+                            substitution_regexp = \
+                                get_substitution_regexp(defines)
+                        sline = substitution_regexp.sub(
+                            lambda match: str(defines[match.group(0)]),
+                            sline)
+                    output_lines.append(sline)
                 elif should_keep_lines:
-                    logger.debug("keep blank line (%s)" % states[-1][1])
-                    temp_output_buffer.write("\n")
+                    logger.debug("keep blank line (%s)" % states[-1].has_emitted)
+                    output_lines.append("\n")
                 else:
-                    logger.debug("skip line (%s)" % states[-1][1])
+                    logger.debug("skip line (%s)" % states[-1].has_emitted)
             except IndexError:
                 raise PreprocessorError("superfluous #endif before this line",
-                                        defines['__FILE__'],
-                                        defines['__LINE__'])
+                                        input_filename, line_number)
     if len(states) > 1:
-        raise PreprocessorError("unterminated #if block", defines['__FILE__'],
-                                defines['__LINE__'])
+        raise PreprocessorError("unterminated #if block", input_filename,
+                                line_number)
     elif len(states) < 1:
         raise PreprocessorError("superfluous #endif on or before this line",
-                                defines['__FILE__'], defines['__LINE__'])
+                                input_filename, line_number)
+
+    _flush_output_lines()
 
     #if temp_output_buffer != output_file:
     #    temp_output_buffer.close()
@@ -478,12 +808,17 @@ def parse_int_token(token):
             ...
         ValueError: invalid literal for int() with base 10: 'foobar'
     """
-    if token.startswith("0x") or token.startswith("0X"):
-        return int(token, 16)
-    elif token.startswith("0"):
+    # Dispatch on the leading characters directly: anything not starting
+    # with '0' (the overwhelmingly common case) is decimal, so it pays
+    # neither startswith call.
+    if token[:1] == "0":
+        if token[1:2] in ("x", "X"):
+            return int(token, 16)
         return int(token, 8)
-    else:
-        return int(token)
+    return int(token)
+
+
+_BOOLEAN_TOKENS = {'true': True, 'false': False}
 
 
 def parse_bool_token(token):
@@ -509,7 +844,22 @@ def parse_bool_token(token):
         >>> parse_bool_token('TRUE')
         True
     """
-    return {'true': True, 'false': False}.get(token.lower(), token)
+    # Only tokens starting with t/T/f/F can possibly be booleans; all
+    # others skip both the lower() copy and the table lookup.
+    if token[:1] in 'tTfF':
+        return _BOOLEAN_TOKENS.get(token.lower(), token)
+    return token
+
+
+# What float() will be handed by parse_number_token: a decimal point
+# with digits on at least one side, an optional exponent, optional sign
+# and surrounding blanks. One anchored match replaces the '.' in token
+# scan and rules the float() failure path out up front, so tokens like
+# version strings ('1.2.3') never pay for a raised-and-caught ValueError
+# from float(). Dot-less exponent forms ('2e-23') stay excluded, per the
+# documented caveat.
+_FLOAT_TOKEN_REGEXP = re.compile(
+    r'[ \t]*[-+]?(?:\d+\.\d*|\.\d+)(?:[eE][-+]?\d+)?[ \t]*\Z')
 
 
 def parse_number_token(token):
@@ -535,6 +885,8 @@ def parse_number_token(token):
         40
         >>> parse_number_token("4.0")
         4.0
+        >>> parse_number_token("1.5e3")
+        1500.0
         >>> parse_number_token("2e-23")
         Traceback (most recent call last):
             ...
@@ -544,7 +896,8 @@ def parse_number_token(token):
             ...
         ValueError: invalid literal for int() with base 10: 'foobar'
     """
-    return float(token) if '.' in token else parse_int_token(token)
+    return float(token) if _FLOAT_TOKEN_REGEXP.match(token) \
+                        else parse_int_token(token)
 
 
 def parse_definition_expr(expr, default_value=None):
@@ -576,6 +929,8 @@ def parse_definition_expr(expr, default_value=None):
         ('DEBUG', 1)
         >>> parse_definition_expr('FOOBAR=0x40')
         ('FOOBAR', 64)
+        >>> parse_definition_expr('RATE=1.5e3')
+        ('RATE', 1500.0)
         >>> parse_definition_expr('FOOBAR=whatever')
         ('FOOBAR', 'whatever')
         >>> parse_definition_expr('FOOBAR=false')
@@ -601,19 +956,20 @@ def parse_definition_expr(expr, default_value=None):
         >>> parse_definition_expr(None)
         Traceback (most recent call last):
             ...
-        AttributeError: 'NoneType' object has no attribute 'split'
+        AttributeError: 'NoneType' object has no attribute 'partition'
     """
-    try:
-        define, value = expr.split('=', 1)
+    # partition never raises on a missing '=', so the valueless form is
+    # an ordinary branch instead of exception-based control flow.
+    define, sep, value = expr.partition('=')
+    if sep:
         try:
             value = parse_number_token(value)
         except ValueError:
             value = parse_bool_token(value)
-    except ValueError:
-        if expr:
-            define, value = expr, default_value
-        else:
-            raise ValueError("Invalid definition expression `%s`" % str(expr))
+    elif expr:
+        value = default_value
+    else:
+        raise ValueError("Invalid definition expression `%s`" % str(expr))
     d = define.strip()
     if d:
         return d, value
@@ -653,23 +1009,30 @@ def parse_definitions(definitions):
         >>> parse_definitions([])
         {}
     """
-    defines = {}
-    if definitions:
-        for definition in definitions:
-            define, value = parse_definition_expr(definition,
-                                                  default_value=None)
-            defines[define] = value
-    return defines
+    if not definitions:
+        return {}
+    # parse_definition_expr returns (define, value) pairs, which is
+    # exactly what the C-level dict constructor consumes - no
+    # Python-level item assignment per definition.
+    return dict(parse_definition_expr(definition, default_value=None)
+                for definition in definitions)
 
 
-def parse_command_line():
+# Built lazily by get_argument_parser(); constructing the parser is the
+# bulk of parse_command_line's cost and need only happen once.
+_argument_parser = None
+
+
+def get_argument_parser():
     """
-    Parses the command line and returns a ``Namespace`` object
-    containing options and their values.
+    Builds, caches, and returns the command-line argument parser.
 
     :return:
-        A ``Namespace`` object containing options and their values.
+        An ``argparse.ArgumentParser``, the same instance on every call.
     """
+    global _argument_parser
+    if _argument_parser is not None:
+        return _argument_parser
 
     import argparse
 
@@ -732,7 +1095,7 @@ false value.""")
                         metavar="DIR_PATH",
                         dest='include_paths',
                         action='append',
-                        default=['.'],
+                        default=None,
                         help='Add a directory to the include path for #include directives.')
     parser.add_argument('-k',
                         '--keep-lines',
@@ -779,7 +1142,25 @@ to display content types as read by pepe.""")
                         action='store_true',
                         default=False,
                         help='Display content types configuration and exit.')
-    return parser.parse_args()
+    _argument_parser = parser
+    return parser
+
+
+def parse_command_line():
+    """
+    Parses the command line and returns a ``Namespace`` object
+    containing options and their values.
+
+    :return:
+        A ``Namespace`` object containing options and their values.
+    """
+    args = get_argument_parser().parse_args()
+    # argparse's append action mutates a list default in place, so with
+    # the parser now cached a ['.'] default would accumulate -I
+    # directories across invocations. Keep the registered default
+    # immutable (None) and build the '.'-rooted list fresh per parse.
+    args.include_paths = ['.'] + (args.include_paths or [])
+    return args
 
 
 class NullLoggingHandler(logging.Handler):
@@ -873,7 +1254,7 @@ def main():
                                    defines=defines,
                                    options=args,
                                    content_types_db=content_types_db)
-    except PreprocessorError, ex:
+    except PreprocessorError as ex:
         if logging_level == logging.DEBUG:
             import traceback
             traceback.print_exc(file=sys.stderr)
@@ -72,6 +72,10 @@ content-types:
 
 test_config = yaml.load(test_content_types_yaml)
 
+# Parsed configuration files, keyed by (path, mtime). YAML parsing is
+# slow enough to dominate ContentTypesDatabase construction.
+_config_file_cache = {}
+
 extension_case_transform_func = (lambda w: w)
 if sys.platform.startswith('win'):
     # We lower the pattern case on Windows to keep stuff case insensitive.
@@ -86,6 +90,10 @@ class ContentTypesDatabase(object):
     def __init__(self, config_file=None):
         self._extension_map = {}
         self._regexp_map = {}
+        # Lazily built (regexp, content types) pair fusing all patterns
+        # of _regexp_map into a single alternation; invalidated whenever
+        # a config adds patterns.
+        self._regexp_alternation = None
         self._filename_map = {}
         self._content_types = {}
         self._comment_groups = {}
@@ -186,13 +194,21 @@ class ContentTypesDatabase(object):
         """
         Parses the content.types file and updates the content types database.
 
+        The parsed configuration is memoized per (path, mtime) at module
+        level, so every database instance created in a process shares
+        one YAML parse of e.g. the bundled content-types.yaml.
+
         :param config_filename:
             The path to the configuration file.
         """
-        with open(config_filename, 'rb') as f:
-            content = f.read()
-            config = yaml.load(content)
-            self.add_config(config, config_filename)
+        cache_key = (config_filename, os.path.getmtime(config_filename))
+        try:
+            config = _config_file_cache[cache_key]
+        except KeyError:
+            with open(config_filename, 'rb') as f:
+                config = yaml.load(f.read())
+            _config_file_cache[cache_key] = config
+        self.add_config(config, config_filename)
 
 
     def add_config(self, config, config_filename):
@@ -210,7 +226,7 @@ class ContentTypesDatabase(object):
         self._comment_groups.update(comment_groups)
         self._content_types.update(content_types)
 
-        for content_type, patterns in content_types.iteritems():
+        for content_type, patterns in content_types.items():
             if not patterns:
                 raise ValueError('''error: config parse error: \
 %s: Missing pattern for content type - `%s`"''' % (config_file, content_type))
@@ -224,11 +240,31 @@ class ContentTypesDatabase(object):
                 elif first_character == '/' and last_character == '/':
                     # Regular expression map.
                     self._regexp_map[re.compile(pattern[1:-1])] = content_type
+                    self._regexp_alternation = None
                 else:
                     # Filename map.
                     self._filename_map[pattern] = content_type
 
 
+    def _get_regexp_alternation(self):
+        """
+        Returns a ``(regexp, content_types)`` pair where ``regexp`` is a
+        single compiled alternation of every registered filename pattern
+        and ``content_types`` maps each alternative's index back to its
+        content type. Content type names are not always valid regex
+        group names, so the alternatives are named ``t0``, ``t1``, ...
+        """
+        if self._regexp_alternation is None:
+            patterns = []
+            content_types = []
+            for index, (regexp, content_type) in \
+                    enumerate(self._regexp_map.items()):
+                patterns.append("(?P<t%d>%s)" % (index, regexp.pattern))
+                content_types.append(content_type)
+            self._regexp_alternation = (re.compile("|".join(patterns)),
+                                        content_types)
+        return self._regexp_alternation
+
     def guess_content_type(self, pathname):
         """Guess the content type for the given path.
 
@@ -261,37 +297,45 @@ class ContentTypesDatabase(object):
         content_type = None
 
         # Try to determine from the path.
-        if not content_type and self._filename_map.has_key(file_basename):
+        if not content_type and file_basename in self._filename_map:
             content_type = self._filename_map[file_basename]
             #logger.debug("Content type of '%s' is '%s' (determined from full "\
             #             "path).", pathname, content_type)
 
-        # Try to determine from the suffix.
-        if not content_type and '.' in file_basename:
-            extension = "." + file_basename.split(".")[-1]
-            extension = extension_case_transform_func(extension)
-            try:
-                content_type = self._extension_map[extension]
+        # Try to determine from the suffix. rpartition finds the last
+        # dot in a single scan instead of splitting the basename into a
+        # throwaway list, and an empty separator doubles as the
+        # has-no-extension check.
+        if not content_type:
+            _, dot, extension = file_basename.rpartition(".")
+            if dot:
+                extension = extension_case_transform_func("." + extension)
+                content_type = self._extension_map.get(extension)
                 #logger.debug("Content type of '%s' is '%s' (determined from "\
                 #             "suffix '%s').", pathname, content_type, extension)
-            except KeyError:
-                pass
 
-        # Try to determine from the registered set of regular expression patterns.
-        if not content_type:
-            for regexp, _content_type in self._regexp_map.iteritems():
-                if regexp.search(file_basename):
-                    content_type = _content_type
-                    #logger.debug(
-                    #    "Content type of '%s' is '%s' (matches regexp '%s')",
-                    #    pathname, content_type, regexp.pattern)
-                    break
-
-        # Try to determine from the file contents.
-        if os.path.exists(pathname):
+        # Try to determine from the registered set of regular expression
+        # patterns, fused into a single alternation so one search call
+        # replaces a Python-level scan over every registered pattern.
+        if not content_type and self._regexp_map:
+            regexp, content_types = self._get_regexp_alternation()
+            match = regexp.search(file_basename)
+            if match:
+                for index, _content_type in enumerate(content_types):
+                    if match.group("t%d" % index) is not None:
+                        content_type = _content_type
+                        break
+
+        # Try to determine from the file contents, but only when the
+        # path has not already decided it: paying an open()+read() per
+        # call defeats the point of the cheap path checks above, and an
+        # "<?xml"-prefixed file with a mapped extension (e.g. .html)
+        # should keep its mapped type. Only the first five bytes are
+        # needed for the prolog check; reading the whole file just to
+        # sniff it is wasteful for large inputs.
+        if not content_type and os.path.exists(pathname):
             with open(pathname, 'rb') as f:
-                content = f.read()
-                if content.startswith("<?xml"):  # cheap XML sniffing
+                if f.read(5) == "<?xml":  # cheap XML sniffing
                     content_type = "XML"
 
         # TODO: Try to determine from mime-type.
@@ -0,0 +1,13 @@
+#!python
+
+# #define CRLF 1
+# #ifdef CRLF
+print "CRLF defined"
+# #else
+print "CRLF not defined"
+# #endif
+# #undef CRLF
+# #ifndef CRLF
+print "CRLF undeffed"
+# #endif
+print "bye"
@@ -0,0 +1,5 @@
+#!python
+
+print "CRLF defined"
+print "CRLF undeffed"
+print "bye"